@@ -0,0 +1,223 @@
+# scripts/_ffmpeg.py
+"""
+Shared ffmpeg helpers for the merge scripts: running commands and picking
+an H.264 encoder (hardware when one actually works on this machine, libx264 otherwise).
+"""
+from __future__ import annotations
+
+import hashlib
+import math
+import os
+import subprocess
+from functools import lru_cache
+from pathlib import Path
+from typing import Any
+
+from _jsonio import atomic_write_bytes, dumps, loads
+
+# Tried in order; the first one that passes a test encode wins.
+HW_ENCODERS = ("h264_nvenc", "h264_qsv", "h264_vaapi", "h264_videotoolbox", "h264_amf")
+FALLBACK_ENCODER = "libx264"
+VAAPI_DEVICE = os.getenv("VAAPI_DEVICE", "/dev/dri/renderD128")
+COPYABLE_PIX_FMTS = ("yuv420p", "yuvj420p")
+
+# Prefix for every ffmpeg call made through run(): no stdin, no banner/progress spew, errors only
+FFMPEG_BASE = ("ffmpeg", "-hide_banner", "-nostdin", "-nostats", "-loglevel", "error")
+
+# Per-ffmpeg thread budget. The default (-threads 0 = one per core) mostly adds sync overhead on a
+# 10s clip, and merge_av already runs several ffmpegs side by side.
+DEFAULT_THREADS = int(os.getenv("FFMPEG_THREADS", "2"))
+
+# Seamless-ish loop: keep [0, T-F), crossfade the last F seconds into the first F, concat.
+# {src} is the audio input label ("0:a", "1:a", ...); output label is [outa{n}]. {n} suffixes every
+# internal label so several loops can share one filter graph. {pre} (empty or ending in ",") runs on
+# each branch before the trim, e.g. an aloop when the input is a pipe and -stream_loop can't seek.
+LOOP_XFADE_FILTER = (
+    "[{src}]{pre}atrim=0:{TF},asetpts=PTS-STARTPTS[mid{n}];"
+    "[{src}]{pre}atrim={TF}:{T},asetpts=PTS-STARTPTS[tail{n}];"
+    "[{src}]{pre}atrim=0:{F},asetpts=PTS-STARTPTS[head{n}];"
+    "[tail{n}][head{n}]acrossfade=d={F}:c1=tri:c2=tri[xf{n}];"
+    "[mid{n}][xf{n}]concat=n=2:v=0:a=1[outa{n}]"
+)
+
+DEFAULT_STREAM_LOOP = 10  # used when the input duration can't be probed
+
+PROBE_CACHE_DIR = Path(".cache/ffprobe")
+PROBE_ENTRIES = (
+    "stream=codec_type,codec_name,pix_fmt,r_frame_rate,width,height"
+    ":format=duration:format_tags=comment"
+)
+_probe_cache: dict[tuple[str, int, int], dict[str, Any]] = {}
+
+
+def run(cmd: list[str]) -> None:
+    # Bytes in, decoded only on failure; stdout is never read (ffmpeg reports on stderr)
+    p = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if p.returncode != 0:
+        raise RuntimeError(
+            f"Command failed:\n{' '.join(cmd)}\n\nOutput:\n{p.stderr.decode('utf-8', 'replace')}"
+        )
+
+
+def thread_args(threads: int, copy: bool = False) -> list[str]:
+    # Output option; stream copy has only the audio encode left, so one thread is plenty
+    return ["-threads", "1" if copy else str(threads)]
+
+
+def loop_xfade_graph(src: str, seconds: float, xfade: float, n: str = "", pre: str = "") -> str:
+    return LOOP_XFADE_FILTER.format(src=src, T=seconds, F=xfade, TF=seconds - xfade, n=n, pre=pre)
+
+
+def looped_tag(seconds: float) -> str:
+    # comment= metadata on audio that already went through the loop graph (generate_audio --loop)
+    return f"looped:{float(seconds):g}"
+
+
+def encoder_args(encoder: str) -> tuple[list[str], list[str]]:
+    """
+    Returns (pre_input_args, output_args) for an H.264 encoder at roughly
+    libx264-default quality. pre_input_args go before the first -i.
+    """
+    if encoder == "h264_nvenc":
+        return [], ["-c:v", encoder, "-preset", "p4", "-tune", "hq", "-rc", "vbr", "-cq", "23", "-b:v", "0",
+                    "-pix_fmt", "yuv420p"]
+    if encoder == "h264_qsv":
+        return [], ["-c:v", encoder, "-preset", "veryfast", "-global_quality", "23", "-pix_fmt", "nv12"]
+    if encoder == "h264_vaapi":
+        return ["-vaapi_device", VAAPI_DEVICE], ["-vf", "format=nv12,hwupload", "-c:v", encoder, "-qp", "23"]
+    if encoder == "h264_videotoolbox":
+        return [], ["-c:v", encoder, "-b:v", "8M", "-pix_fmt", "yuv420p"]
+    if encoder == "h264_amf":
+        return [], ["-c:v", encoder, "-quality", "speed", "-rc", "cqp", "-qp_i", "22", "-qp_p", "24",
+                    "-pix_fmt", "yuv420p"]
+    return [], ["-c:v", encoder, "-pix_fmt", "yuv420p"]
+
+
+def _encoder_works(encoder: str) -> bool:
+    # Being listed by -encoders only means ffmpeg was built with it; the GPU/driver may still be missing
+    pre, out = encoder_args(encoder)
+    cmd = [
+        "ffmpeg", "-hide_banner", "-nostdin", "-loglevel", "error", *pre,
+        "-f", "lavfi", "-i", "color=c=black:s=256x256:d=0.1",
+        "-frames:v", "1", *out, "-f", "null", "-",
+    ]
+    try:
+        return subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=30).returncode == 0
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+
+
+@lru_cache(maxsize=None)
+def detect_hw_encoder() -> str:
+    """
+    Picks the first working hardware H.264 encoder, else libx264. Checked once per process.
+    FFMPEG_ENCODER overrides detection (e.g. FFMPEG_ENCODER=libx264 to force CPU encoding).
+    """
+    forced = os.getenv("FFMPEG_ENCODER")
+    if forced:
+        return forced
+    try:
+        listing = subprocess.run(
+            ["ffmpeg", "-hide_banner", "-encoders"],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True,
+        ).stdout
+    except OSError:
+        return FALLBACK_ENCODER
+    available = {line.split()[1] for line in listing.splitlines() if len(line.split()) > 1}
+    for encoder in HW_ENCODERS:
+        if encoder in available and _encoder_works(encoder):
+            return encoder
+    return FALLBACK_ENCODER
+
+
+def _file_key(path: Path) -> tuple[str, int, int]:
+    st = path.stat()
+    return (str(path.resolve()), st.st_mtime_ns, st.st_size)
+
+
+def ffprobe(path: Path) -> dict[str, Any]:
+    """
+    ffprobe's JSON for PROBE_ENTRIES (stream codec/pix_fmt/rate/size, format duration + comment tag),
+    cached in memory and on disk under PROBE_CACHE_DIR. The cache file name includes mtime and
+    size, so a changed file is simply a miss. Returns {} if ffprobe fails (failures aren't persisted).
+    """
+    key = _file_key(path)
+    if key in _probe_cache:
+        return _probe_cache[key]
+
+    # PROBE_ENTRIES is hashed in too: asking ffprobe for more fields must not hit older, narrower entries
+    digest = hashlib.sha1(f"{key[0]}\0{PROBE_ENTRIES}".encode()).hexdigest()
+    cache_file = PROBE_CACHE_DIR / f"{digest}-{key[1]}-{key[2]}.json"
+    try:
+        data = loads(cache_file.read_bytes())
+    except (OSError, ValueError):
+        data = None
+
+    if not isinstance(data, dict):
+        cmd = [
+            "ffprobe", "-v", "error",
+            "-show_entries", PROBE_ENTRIES,
+            "-of", "json", str(path),
+        ]
+        data = {}
+        try:
+            p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            if p.returncode == 0:
+                data = loads(p.stdout)
+                atomic_write_bytes(cache_file, dumps(data))
+        except (OSError, ValueError):
+            data = {}
+
+    _probe_cache[key] = data
+    return data
+
+
+def probe_duration(path: Path) -> float:
+    """Container duration in seconds; 0.0 if unknown."""
+    try:
+        return float((ffprobe(path).get("format") or {}).get("duration") or 0.0)
+    except ValueError:
+        return 0.0
+
+
+def stream_loop_count(path: Path, seconds: float) -> int:
+    # -stream_loop N plays the input N+1 times; ceil(T/dur) leaves one loop of slack for rounding
+    duration = probe_duration(path)
+    if duration <= 0:
+        return DEFAULT_STREAM_LOOP
+    if duration >= seconds:
+        return 0
+    return max(1, math.ceil(seconds / duration))
+
+
+def audio_loop_args(src: str, path: Path, seconds: float, xfade: float, n: str = "") -> tuple[list[str], str]:
+    """
+    (input args for `path`, filter graph ending in [outa{n}]) that loop it to `seconds` with the
+    end->start crossfade. Audio tagged looped_tag(seconds) passes through untouched: looping it
+    again would only re-read it and crossfade the already seamless seam a second time.
+    """
+    tags = (ffprobe(path).get("format") or {}).get("tags") or {}
+    if tags.get("comment") == looped_tag(seconds):
+        return [], f"[{src}]anull[outa{n}]"
+    return ["-stream_loop", str(stream_loop_count(path, seconds))], loop_xfade_graph(src, seconds, xfade, n)
+
+
+def probe_video(path: Path) -> dict[str, Any]:
+    """
+    First video stream's codec_name/pix_fmt/r_frame_rate/width/height plus container duration (seconds).
+    Returns {} if there is no video stream or ffprobe fails.
+    """
+    stream = next((s for s in ffprobe(path).get("streams") or [] if s.get("codec_type") == "video"), None)
+    if stream is None:
+        return {}
+    return {**stream, "duration": probe_duration(path)}
+
+
+def can_copy_video(path: Path, min_seconds: float) -> bool:
+    # Already H.264 4:2:0 and long enough: re-muxing is enough, no re-encode needed
+    info = probe_video(path)
+    return (
+        info.get("codec_name") == "h264"
+        and info.get("pix_fmt") in COPYABLE_PIX_FMTS
+        and info.get("duration", 0.0) >= min_seconds
+    )
@@ -0,0 +1,72 @@
+# scripts/_jsonio.py
+"""
+JSON and file-write helpers shared by the scripts.
+Uses orjson when installed (faster, works on bytes directly), else stdlib json.
+Output is always UTF-8 bytes with non-ASCII kept as-is.
+"""
+from __future__ import annotations
+
+import os
+import stat
+import tempfile
+from pathlib import Path
+from typing import Any
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - stdlib fallback
+    orjson = None
+    import json
+
+# Read once at import (os.umask can only be read by setting it); default mode for newly created files
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def loads(data: bytes | str) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj: Any, indent: bool = False, newline: bool = False) -> bytes:
+    if orjson is not None:
+        option = (orjson.OPT_INDENT_2 if indent else 0) | (orjson.OPT_APPEND_NEWLINE if newline else 0)
+        return orjson.dumps(obj, option=option)
+    # Compact separators match orjson's default (no spaces) when not indenting
+    out = json.dumps(obj, ensure_ascii=False, indent=2) if indent else json.dumps(
+        obj, ensure_ascii=False, separators=(",", ":")
+    )
+    return (out + "\n" if newline else out).encode("utf-8")
+
+
+def match_target_mode(fd: int, path: Path) -> None:
+    """
+    Gives a temp file (mkstemp/NamedTemporaryFile create them 0600) the mode of the file it is about
+    to replace, or the umask default for a new one; os.replace keeps the temp file's mode otherwise.
+    """
+    try:
+        mode = stat.S_IMODE(os.stat(path).st_mode)
+    except FileNotFoundError:
+        mode = 0o666 & ~_UMASK
+    if hasattr(os, "fchmod"):  # not on Windows before 3.13, where a file has no POSIX mode anyway
+        os.fchmod(fd, mode)
+
+
+def atomic_write_bytes(path: Path, data: bytes) -> None:
+    """
+    Writes via a temp file in the same folder + os.replace, so readers
+    always see either the old or the new file (never a truncated one).
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=path.parent, prefix=path.name + ".", suffix=".tmp", delete=False) as tmp:
+        try:
+            match_target_mode(tmp.fileno(), path)
+            tmp.write(data)
+            tmp.flush()
+            os.fsync(tmp.fileno())
+        except BaseException:
+            tmp.close()
+            os.unlink(tmp.name)
+            raise
+    os.replace(tmp.name, path)
@@ -0,0 +1,55 @@
+# scripts/_prompt_cache.py
+"""
+Persistent cache for generated prompt items, keyed per brief.
+Backed by sqlite at runs/.prompt_cache.sqlite so repeated briefs skip the OpenAI call.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import sqlite3
+import time
+from pathlib import Path
+from typing import Any, Optional
+
+from _jsonio import dumps, loads
+
+CACHE_PATH = Path("runs/.prompt_cache.sqlite")
+
+
+def make_key(*parts: Any) -> str:
+    # stdlib json (not orjson) so the key bytes are identical whether or not orjson is installed.
+    blob = json.dumps(parts, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.blake2b(blob.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def _connect() -> sqlite3.Connection:
+    CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(CACHE_PATH)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, created_at INTEGER)"
+    )
+    return conn
+
+
+def get(key: str) -> Optional[dict]:
+    if not CACHE_PATH.exists():
+        return None
+    conn = _connect()
+    try:
+        row = conn.execute("SELECT value FROM cache WHERE key = ?", (key,)).fetchone()
+    finally:
+        conn.close()
+    return loads(row[0]) if row else None
+
+
+def put(key: str, value: dict) -> None:
+    conn = _connect()
+    try:
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, created_at) VALUES (?, ?, ?)",
+                (key, dumps(value), int(time.time())),
+            )
+    finally:
+        conn.close()
@@ -1,3 +1,4 @@
+import os
 from pathlib import Path
 
 RUNS_DIR = Path("runs")
@@ -7,16 +8,20 @@ def latest_run_dir() -> Path:
     Returns the newest run directory inside /runs based on folder name.
     Expected format: YYYY-MM-DD or YYYY-MM-DD_xxx
     """
-    if not RUNS_DIR.exists():
+    if not os.path.isdir(RUNS_DIR):
         raise FileNotFoundError("runs/ folder not found")
 
-    run_dirs = [p for p in RUNS_DIR.iterdir() if p.is_dir()]
-    if not run_dirs:
+    # Names sort lexicographically (YYYY-MM-DD). Newest = max; one scandir pass, no sort.
+    with os.scandir(RUNS_DIR) as it:
+        newest = max(
+            (e for e in it if e.is_dir(follow_symlinks=False)),
+            key=lambda e: e.name,
+            default=None,
+        )
+    if newest is None:
         raise FileNotFoundError("No run folders found inside runs/")
 
-    # Sort by name (YYYY-MM-DD works lexicographically). Newest = last.
-    run_dirs.sort(key=lambda p: p.name)
-    return run_dirs[-1]
+    return Path(newest.path)
 
 def run_paths(run_dir: Path) -> dict:
     return {
@@ -1,71 +1,210 @@
 # scripts/generate_audio.py
 from __future__ import annotations
 
-import json
+import argparse
 import os
 import re
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from _ffmpeg import FFMPEG_BASE, loop_xfade_graph, looped_tag
+from _jsonio import loads, match_target_mode
 
 PROMPTS_PATH = Path("prompts/prompts_today.json")
 OUT_DIR = Path("audio_raw")
+RAW_DIR = OUT_DIR / "raw"
 
 # ElevenLabs endpoints verschillen per product. Deze gebruikt de "sound generation / SFX" stijl.
 # Als jouw account een andere endpoint vereist, dan faalt hij met 404/400 en dan passen we hem aan.
 ELEVEN_SFX_URL = "https://api.elevenlabs.io/v1/sound-generation"
 
-def sanitize_id(n: int) -> str:
-    return f"{n:02d}"
+# Calls zijn puur netwerk/IO-bound: threads schalen tot de rate limits van ElevenLabs.
+MAX_WORKERS = 8
+CHUNK_SIZE = 64 * 1024
+
+# ElevenLabs SFX generatie is doorgaans prompt + duration
+_PAYLOAD_BASE = {"duration_seconds": 8}
+_NAME_FMT = "audio_{:02d}.wav".format
+
+# pipe:0 is niet seekbaar, dus -stream_loop kan niet terugspoelen; aloop houdt de (paar MB) samples
+# in RAM en speelt ze eindeloos af, de atrims in de loop-graph kappen het daarna af.
+_PIPE_LOOP = "aloop=loop=-1:size=2147483647,"
 
 def ensure_prompts():
     if not PROMPTS_PATH.exists():
         raise SystemExit(f"Missing {PROMPTS_PATH}. Run generate_prompts_openai_v2.py first.")
-    data = json.loads(PROMPTS_PATH.read_text(encoding="utf-8"))
+    data = loads(PROMPTS_PATH.read_bytes())
     if not isinstance(data, list) or len(data) == 0:
         raise SystemExit("prompts_today.json is empty or not a list.")
     return data
 
-def main():
-    api_key = os.getenv("ELEVENLABS_API_KEY")
-    if not api_key:
-        raise SystemExit("Missing ELEVENLABS_API_KEY in env/secrets.")
-
-    items = ensure_prompts()
-    OUT_DIR.mkdir(parents=True, exist_ok=True)
-
-    headers = {
+def make_session(api_key: str) -> requests.Session:
+    session = requests.Session()
+    session.headers.update({
         "xi-api-key": api_key,
         "Content-Type": "application/json",
         "Accept": "audio/wav",
-    }
+    })
+    # 429/5xx worden met backoff opnieuw geprobeerd i.p.v. de hele batch af te breken.
+    # POST staat niet in de default allowed_methods van urllib3, dus expliciet toestaan.
+    retries = Retry(
+        total=3,
+        backoff_factor=1.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=None,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=MAX_WORKERS, pool_maxsize=MAX_WORKERS, max_retries=retries)
+    session.mount("https://", adapter)
+    return session
+
+def _prompt(item: dict) -> tuple[int, str]:
+    idx = int(item.get("id", 0) or 0)
+    prompt = item.get("audio_prompt", "").strip()
+    if not prompt:
+        raise SystemExit(f"Item id={idx} missing audio_prompt")
+    return idx, prompt
+
+def _post(session: requests.Session, idx: int, prompt: str) -> requests.Response:
+    payload = {"text": prompt, **_PAYLOAD_BASE}
+    # stream=True: de WAV komt chunk-voor-chunk binnen i.p.v. eerst volledig in RAM
+    r = session.post(ELEVEN_SFX_URL, json=payload, timeout=120, stream=True)
+    if r.status_code >= 400:
+        r.close()
+        raise SystemExit(
+            f"ElevenLabs error for id={idx}: {r.status_code}\n{r.text}\n"
+            f"Endpoint used: {ELEVEN_SFX_URL}"
+        )
+    return r
+
+def _generate(item: dict, session: requests.Session) -> Path:
+    idx, prompt = _prompt(item)
+    out_path = OUT_DIR / _NAME_FMT(idx)
+
+    with _post(session, idx, prompt) as r:
+        # Via temp file + os.replace: een afgebroken download laat nooit een halve WAV achter
+        fd, tmp_name = tempfile.mkstemp(dir=OUT_DIR, prefix=out_path.name + ".", suffix=".tmp")
+        try:
+            match_target_mode(fd, out_path)
+            with os.fdopen(fd, "wb") as fp:
+                for chunk in r.iter_content(CHUNK_SIZE):
+                    if chunk:
+                        fp.write(chunk)
+            os.replace(tmp_name, out_path)
+        except BaseException:
+            os.unlink(tmp_name)
+            raise
+
+    return out_path
+
+def generate_and_loop(item: dict, session: requests.Session, seconds: float, xfade: float,
+                      keep_raw: bool = False) -> Path:
+    """
+    Streamt de SFX-response rechtstreeks in ffmpeg (stdin) die loopt + crossfadet naar een
+    {seconds}s WAV in OUT_DIR; de ruwe bytes raken de disk alleen met keep_raw (RAW_DIR).
+    """
+    idx, prompt = _prompt(item)
+    out_path = OUT_DIR / _NAME_FMT(idx)
+
+    # stderr naar een temp file i.p.v. PIPE: zo kan ffmpeg nooit blokkeren terwijl wij stdin vullen
+    with _post(session, idx, prompt) as r, tempfile.TemporaryFile() as err:
+        # Zelfde temp-naam als _generate (audio_NN.wav.xxx.tmp): merge_av ziet hem nooit als audio,
+        # dus een afgebroken job laat geen halve WAV in de inbox. -f wav omdat de extensie .tmp is.
+        fd, part_name = tempfile.mkstemp(dir=OUT_DIR, prefix=out_path.name + ".", suffix=".tmp")
+        try:
+            match_target_mode(fd, out_path)  # ffmpeg -y leegt het bestand maar houdt de mode
+        finally:
+            os.close(fd)
+        part = Path(part_name)
+        cmd = [
+            *FFMPEG_BASE, "-y",
+            "-i", "pipe:0",
+            "-filter_complex", loop_xfade_graph("0:a", seconds, xfade, pre=_PIPE_LOOP),
+            "-map", "[outa]",
+            "-t", f"{seconds}",
+            "-ac", "2",
+            "-ar", "48000",
+            "-metadata", f"comment={looped_tag(seconds)}",  # merge_av muxt hem dan zonder opnieuw te loopen
+            "-f", "wav",
+            str(part),
+        ]
+
+        proc = raw_fp = raw_tmp = None
+        try:
+            if keep_raw:
+                fd, raw_name = tempfile.mkstemp(dir=RAW_DIR, prefix=out_path.name + ".", suffix=".tmp")
+                raw_fp, raw_tmp = os.fdopen(fd, "wb"), Path(raw_name)
+                match_target_mode(fd, RAW_DIR / out_path.name)
+            proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=err)
+            try:
+                for chunk in r.iter_content(CHUNK_SIZE):
+                    if chunk:
+                        proc.stdin.write(chunk)
+                        if raw_fp:
+                            raw_fp.write(chunk)
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass  # ffmpeg is al gestopt; returncode + stderr hieronder zeggen waarom
+            if proc.wait() != 0:
+                err.seek(0)
+                raise RuntimeError(
+                    f"Command failed:\n{' '.join(cmd)}\n\nOutput:\n{err.read().decode('utf-8', 'replace')}"
+                )
+            os.replace(part, out_path)
+            if raw_fp:
+                raw_fp.close()
+                os.replace(raw_tmp, RAW_DIR / out_path.name)
+        except BaseException:
+            if proc is not None:
+                proc.kill()
+                proc.wait()
+            part.unlink(missing_ok=True)
+            if raw_fp:
+                raw_fp.close()
+                raw_tmp.unlink(missing_ok=True)
+            raise
+
+    return out_path
 
-    for item in items:
-        idx = int(item.get("id", 0) or 0)
-        if idx <= 0:
-            continue
-
-        prompt = item.get("audio_prompt", "").strip()
-        if not prompt:
-            raise SystemExit(f"Item id={idx} missing audio_prompt")
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--loop", action="store_true",
+                    help="Pipe each response straight into ffmpeg and write the looped WAV (no raw file)")
+    ap.add_argument("--keep-raw", action="store_true",
+                    help=f"With --loop: also keep the raw response in {RAW_DIR}/")
+    ap.add_argument("--seconds", type=float, default=10.0, help="Loop target duration (default 10)")
+    ap.add_argument("--xfade", type=float, default=0.35, help="Loop crossfade seconds (default 0.35)")
+    args = ap.parse_args()
+    if args.keep_raw and not args.loop:
+        ap.error("--keep-raw only applies with --loop")
 
-        # ElevenLabs SFX generatie is doorgaans prompt + duration
-        payload = {
-            "text": prompt,
-            "duration_seconds": 8,
-        }
+    api_key = os.getenv("ELEVENLABS_API_KEY")
+    if not api_key:
+        raise SystemExit("Missing ELEVENLABS_API_KEY in env/secrets.")
 
-        out_path = OUT_DIR / f"audio_{sanitize_id(idx)}.wav"
+    items = [it for it in ensure_prompts() if int(it.get("id", 0) or 0) > 0]
+    if not items:
+        return
+    OUT_DIR.mkdir(parents=True, exist_ok=True)
+    if args.keep_raw:
+        RAW_DIR.mkdir(exist_ok=True)
 
-        r = requests.post(ELEVEN_SFX_URL, headers=headers, json=payload, timeout=120)
-        if r.status_code >= 400:
-            raise SystemExit(
-                f"ElevenLabs error for id={idx}: {r.status_code}\n{r.text}\n"
-                f"Endpoint used: {ELEVEN_SFX_URL}"
-            )
+    def job(item: dict, session: requests.Session) -> Path:
+        if args.loop:
+            return generate_and_loop(item, session, args.seconds, args.xfade, args.keep_raw)
+        return _generate(item, session)
 
-        out_path.write_bytes(r.content)
-        print(f"Wrote {out_path}")
+    with make_session(api_key) as session:
+        with ThreadPoolExecutor(max_workers=min(len(items), MAX_WORKERS)) as ex:
+            futures = [ex.submit(job, it, session) for it in items]
+            for f in as_completed(futures):
+                print(f"Wrote {f.result()}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,34 +1,67 @@
 # scripts/generate_prompts_openai_v2.py
 from __future__ import annotations
 
-import json
+import argparse
+import hashlib
 import os
 import random
 import re
-from dataclasses import dataclass
-from datetime import datetime
-from hashlib import sha256
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from datetime import date, timedelta
+from importlib.util import find_spec
 from pathlib import Path
-from typing import Any, List
+from secrets import token_hex
+from textwrap import shorten
+from typing import TYPE_CHECKING, Any, Callable, List, Optional, TypeVar
 
-from openai import OpenAI
+try:
+    import fcntl  # POSIX only; serializes history appends from concurrent runs
+except ImportError:
+    fcntl = None
+
+if TYPE_CHECKING:
+    from openai import OpenAI
+
+# openai/httpx are imported lazily (get_client, _call_openai): importing this module
+# for its constants stays stdlib-only and skips their cold-import cost.
+
+import _prompt_cache
+from _jsonio import atomic_write_bytes, dumps, loads
 
 # =========================================================
 # PATHS & SETTINGS
 # =========================================================
 
 OUT_PATH = Path("prompts/prompts_today.json")
-HISTORY_PATH = Path("prompts/history.json")
+HISTORY_PATH = Path("prompts/history.jsonl")  # append-only, one entry per line
+HISTORY_TAIL_BYTES = 64 * 1024
+LEGACY_HISTORY_PATH = Path("prompts/history.json")  # old single-list format, migrated once
 
 N_ITEMS = int(os.getenv("N_PROMPTS", "3"))
 MODEL = os.getenv("OPENAI_MODEL", "gpt-4.1-mini")
 TEMPERATURE = float(os.getenv("OPENAI_TEMPERATURE", "0.65"))
+SEED = os.getenv("SLIME_SEED")  # optional: fixed seed makes brief sampling reproducible
+
+# Batch API: ~50% cheaper, asynchronous (up to 24h). Meant for cron runs; interactive runs stay sync.
+USE_BATCH_API = "1" in (os.getenv("USE_BATCH_API"), os.getenv("USE_BATCH"))
+BATCH_POLL_SECONDS = float(os.getenv("BATCH_POLL_SECONDS", "30"))
+BATCH_POLL_MAX_SECONDS = 300.0
+BATCH_INPUT_PATH = Path("prompts/batch_input.jsonl")
+BATCH_STATE_PATH = Path("prompts/batch_state.json")  # batch id + seed of a submitted, unfinished batch
+
+MAX_CONCURRENT = int(os.getenv("OPENAI_MAX_CONCURRENT", "8"))  # parallel sync requests
+ITEMS_PER_REQUEST = int(os.getenv("ITEMS_PER_REQUEST", "10"))  # briefs packed into one request
+OPENAI_RPM = float(os.getenv("OPENAI_RPM", "500"))  # account limits; throttle below them instead of eating 429s
+OPENAI_TPM = float(os.getenv("OPENAI_TPM", "200000"))
 
 # =========================================================
 # SURFACES (ALWAYS HORIZONTAL / PREMIUM)
 # =========================================================
 
-SURFACES_LIB = [
+SURFACES_LIB: tuple[str, ...] = (
     "horizontal polished black marble tabletop with fine white veining",
     "horizontal satin-finished onyx stone tabletop with translucent layers",
     "horizontal brushed metal tabletop with soft cinematic reflections",
@@ -37,13 +70,13 @@ SURFACES_LIB = [
     "horizontal mother-of-pearl inlay tabletop with subtle iridescence",
     "horizontal glazed ceramic tabletop with luxury sheen",
     "horizontal glazed porcelain tabletop with subtle crackle texture",
-]
+)
 
 # =========================================================
 # BACKGROUNDS — INDOOR + OUTDOOR (WITH MOUNTAIN VARIANTS)
 # =========================================================
 
-BACKGROUNDS_LIB = [
+BACKGROUNDS_LIB: tuple[str, ...] = (
     # ===== INDOOR =====
     "luxury penthouse lounge at night with glowing city lights and deep contrast, softly blurred",
     "high-end spa interior with warm stone walls and drifting steam, softly blurred",
@@ -64,13 +97,13 @@ BACKGROUNDS_LIB = [
     "desert stone plateau during fiery sunset with dramatic sky gradients, softly blurred",
     "quiet forest clearing at sunrise with warm light shafts, softly blurred",
     "forest overlook during autumn twilight with deep amber tones, softly blurred",
-]
+)
 
 # =========================================================
 # COLOR PALETTES — ALWAYS COLORFUL & HOOKY
 # =========================================================
 
-PALETTES_LIB = [
+PALETTES_LIB: tuple[str, ...] = (
     "deep emerald green blending into sapphire blue with glowing gold highlights",
     "neon magenta blending into electric cyan with subtle violet glow",
     "lava orange and molten amber with deep crimson shadows and inner glow",
@@ -80,13 +113,13 @@ PALETTES_LIB = [
     "midnight blue with bioluminescent cyan streaks and soft glow",
     "sunset gradient slime: coral, peach, and warm gold with glowing edges",
     "electric blue with neon lime accents and faint internal glow",
-]
+)
 
 # =========================================================
 # SLIME TYPES — VISUAL MAGIE + CONTINUOUS ARRIVAL FROM ABOVE
 # =========================================================
 
-SLIME_TYPES = [
+SLIME_TYPES: tuple[dict, ...] = (
     {
         "type": "thick glossy slime",
         "visual": (
@@ -108,13 +141,13 @@ SLIME_TYPES = [
             "rainbow-like light shifts, subtle internal glow, rich saturated tones"
         ),
     },
-]
+)
 
-SCENE_PATTERNS = [
+SCENE_PATTERNS: tuple[str, ...] = (
     "new slime continuously arrives from just above the frame and folds over the existing slime in rounded layers",
     "a steady uninterrupted ribbon of slime enters from above, merging smoothly and folding over itself on the tabletop",
     "incoming slime from above continuously drapes and folds onto the existing mass, maintaining calm hypnotic motion",
-]
+)
 
 # =========================================================
 # HARD RULES (VIDEO + AUDIO)
@@ -165,59 +198,162 @@ Slightly moist, cohesive texture with gentle compression and smooth release.
 Studio-quality close-mic recording, no voice, no music, no ambience. Duration: 8 seconds.
 """
 
-JSON_SCHEMA = """
-Return VALID JSON ONLY in this exact schema:
-[
-  {
-    "id": 1,
-    "surface": "string",
-    "background": "string",
-    "palette": "string",
-    "slime_type": "string",
-    "video_prompt": "string",
-    "audio_prompt": "string"
-  }
-]
+# Byte-identical across runs and calls so OpenAI's automatic prompt caching can reuse the prefix.
+# Anything per-run (history, briefs, ids, dates) goes in later messages, never in here.
+STATIC_SYSTEM_PROMPT = f"""
+You generate premium macro ASMR video and audio prompts.
+
+{BASE_RULES}
+
+CENTERING / COMPOSITION (MANDATORY):
+- Main slime mass centered with wide safe margins; never near edges/corners; no off-center framing; no drift.
+- Include this exact line in every video_prompt (verbatim):
+{COMPOSITION_RULE}
+
+{AUDIO_RULES}
+
+COLOR CONTRAST RULE:
+- Cold/dark background (snow, night, blue hour): warm or neon slime.
+- Warm background (sunset, desert): include cool or contrasting tones.
+- Never plain white, gray, or colorless slime.
+
+{AUDIO_STYLE_ANCHOR}
+EVERY audio_prompt: thick/cohesive, soft rounded folds, slow calm settling, slightly moist; 2–3 short lines;
+end with "Studio-quality close-mic recording, no voice, no music, no ambience. Duration: 8 seconds."
 """
 
+# The model only writes the free-text fields; surface/background/palette/slime_type come from the brief
+_ITEM_FIELDS = ("video_prompt", "audio_prompt")
+
+OUTPUT_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "required": ["id", *_ITEM_FIELDS],
+        "properties": {
+            "id": {"type": "integer"},
+            **{k: {"type": "string"} for k in _ITEM_FIELDS},
+        },
+        "additionalProperties": False,
+    },
+}
+
+# Structured outputs: the model is constrained to this schema server-side.
+# Strict mode requires an object at the root, so the list is wrapped in {"items": [...]}.
+RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "name": "prompt_batch",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "required": ["items"],
+        "properties": {"items": OUTPUT_SCHEMA},
+        "additionalProperties": False,
+    },
+}
+
+try:
+    import fastjsonschema
+
+    # Compiled once at import into specialized Python code; raises JsonSchemaException (a ValueError)
+    validate_output = fastjsonschema.compile(OUTPUT_SCHEMA)
+except ImportError:  # pragma: no cover - plain fallback
+    def validate_output(data: Any) -> Any:
+        if not isinstance(data, list):
+            raise ValueError("Model output is not a JSON list.")
+        for item in data:
+            if not isinstance(item, dict) or not isinstance(item.get("id"), int):
+                raise ValueError("Model output item is not an object with an integer id.")
+            if any(not isinstance(item.get(k), str) for k in _ITEM_FIELDS):
+                raise ValueError("Model output item is missing a required string field.")
+        return data
+
 # =========================================================
 # HELPERS
 # =========================================================
 
+_ORIENTATION_RE = re.compile(r"\b(vertical|wall|upright|panel)\b", re.IGNORECASE)
+
 def sanitize_surface(text: str) -> str:
-    t = re.sub(r"\b(vertical|wall|upright|panel)\b", "horizontal", text, flags=re.IGNORECASE)
-    if "horizontal" not in t.lower():
+    t = _ORIENTATION_RE.sub("horizontal", text)
+    low = t.lower()  # prefixing "horizontal " can't add "tabletop", so one lower() covers both checks
+    if "horizontal" not in low:
         t = "horizontal " + t
-    if "tabletop" not in t.lower():
+    if "tabletop" not in low:
         t += " tabletop"
     return t
 
+def migrate_legacy_history() -> None:
+    # One-time conversion of the old JSON-list history to JSONL; the legacy file is kept as .bak
+    if not LEGACY_HISTORY_PATH.exists() or HISTORY_PATH.exists():
+        return
+    try:
+        hist = loads(LEGACY_HISTORY_PATH.read_bytes())
+    except ValueError:
+        hist = []
+    entries = [e for e in hist if isinstance(e, dict)] if isinstance(hist, list) else []
+    atomic_write_bytes(HISTORY_PATH, b"".join(dumps(e, newline=True) for e in entries))
+    LEGACY_HISTORY_PATH.replace(LEGACY_HISTORY_PATH.with_suffix(".json.bak"))
+    print(f"Migrated {len(entries)} history entries to {HISTORY_PATH}")
+
 def load_history(limit: int = 12) -> List[dict[str, Any]]:
-    if HISTORY_PATH.exists():
+    # Tail read: only the last HISTORY_TAIL_BYTES are parsed, however long the file grows
+    if not HISTORY_PATH.exists():
+        return []
+    with HISTORY_PATH.open("rb") as f:
+        size = f.seek(0, os.SEEK_END)
+        f.seek(max(0, size - HISTORY_TAIL_BYTES))
+        lines = f.read().splitlines()
+    if size > HISTORY_TAIL_BYTES:
+        lines = lines[1:]  # first line may start mid-entry
+    entries = []
+    for line in [l for l in lines if l.strip()][-limit:]:
         try:
-            return json.loads(HISTORY_PATH.read_text(encoding="utf-8"))[-limit:]
-        except Exception:
-            return []
-    return []
+            entries.append(loads(line))
+        except ValueError:
+            continue
+    return entries
+
+HISTORY_FIELD_CHARS = 40  # leading words are enough for the model to recognise a repeat
+
+def history_digest(history: List[dict[str, Any]], briefs: List[Brief]) -> str:
+    # Only entries sharing a surface/background/palette with these briefs can lead to a similar prompt;
+    # the rest are dropped. One short line each; run id and slime_type (a 3-value enum) add nothing.
+    current = {v for b in briefs for v in (b.surface, b.background, b.palette)}
+    lines = dict.fromkeys(
+        "- " + " | ".join(
+            shorten(str(h.get(k) or ""), HISTORY_FIELD_CHARS, placeholder="…")
+            for k in ("surface", "background", "palette")
+        )
+        for h in history
+        if current.intersection((h.get("surface"), h.get("background"), h.get("palette")))
+    )
+    return "\n".join(lines) or "- (none)"
 
 def save_history(entries: List[dict[str, Any]]) -> None:
-    hist = load_history(200)
-    hist.extend(entries)
+    # O(new entries): append instead of re-reading and rewriting the whole file
     HISTORY_PATH.parent.mkdir(parents=True, exist_ok=True)
-    HISTORY_PATH.write_text(json.dumps(hist, ensure_ascii=False, indent=2), encoding="utf-8")
+    # All entries of a run go out in one write, under an exclusive lock so overlapping runs can't interleave
+    data = b"".join(dumps(e, newline=True) for e in entries)
+    with HISTORY_PATH.open("ab") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        f.write(data)
+        f.flush()
 
 def ensure_composition_line(video_prompt: str) -> str:
-    vp = (video_prompt or "").strip()
     # Always append the composition rule once (keep it short and consistent)
-    if "composition:" not in vp.lower():
-        vp = vp.rstrip(".") + ". " + COMPOSITION_RULE
-    return vp
+    if not video_prompt:
+        return COMPOSITION_RULE
+    if "composition:" in video_prompt.casefold():
+        return video_prompt
+    return video_prompt.rstrip(". \n") + ". " + COMPOSITION_RULE
 
 # =========================================================
 # BUILD UNIQUE BRIEFS (NO DUPLICATES PER RUN)
 # =========================================================
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Brief:
     surface: str
     background: str
@@ -225,148 +361,404 @@ class Brief:
     slime: dict
     scene: str
 
-def build_briefs(n: int) -> List[Brief]:
-    surfaces = random.sample(SURFACES_LIB, n)
-    backgrounds = random.sample(BACKGROUNDS_LIB, n)
-    palettes = random.sample(PALETTES_LIB, n)
-    slimes = random.sample(SLIME_TYPES, n)
-    scenes = random.sample(SCENE_PATTERNS, n)
-
+_POOLS = {
+    "SURFACES_LIB": SURFACES_LIB,
+    "BACKGROUNDS_LIB": BACKGROUNDS_LIB,
+    "PALETTES_LIB": PALETTES_LIB,
+    "SLIME_TYPES": SLIME_TYPES,
+    "SCENE_PATTERNS": SCENE_PATTERNS,
+}
+
+def build_briefs(n: int, rng: Optional[random.Random] = None) -> List[Brief]:
+    # Checked up front: random.sample's "Sample larger than population" doesn't say which pool is short
+    short = [f"{name} ({len(pool)})" for name, pool in _POOLS.items() if len(pool) < n]
+    if short:
+        raise SystemExit(f"N_PROMPTS={n} exceeds the number of unique entries in: {', '.join(short)}")
+    rng = rng or random.Random()
     return [
-        Brief(
-            surface=surfaces[i],
-            background=backgrounds[i],
-            palette=palettes[i],
-            slime=slimes[i],
-            scene=scenes[i],
+        Brief(surface=surface, background=background, palette=palette, slime=slime, scene=scene)
+        for surface, background, palette, slime, scene in zip(
+            rng.sample(SURFACES_LIB, n),
+            rng.sample(BACKGROUNDS_LIB, n),
+            rng.sample(PALETTES_LIB, n),
+            rng.sample(SLIME_TYPES, n),
+            rng.sample(SCENE_PATTERNS, n),
         )
-        for i in range(n)
     ]
 
 # =========================================================
-# MAIN
+# OPENAI CLIENT (ONE POOL PER PROCESS)
 # =========================================================
 
-def main() -> None:
-    api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key:
-        raise SystemExit("Missing OPENAI_API_KEY")
+_client: Optional[OpenAI] = None
+_client_lock = threading.Lock()
+
+def get_client() -> OpenAI:
+    # Reused across calls so keep-alive connections (HTTP/2 when h2 is installed) survive between requests
+    global _client
+    with _client_lock:
+        if _client is None:
+            import httpx
+            from openai import OpenAI
+
+            api_key = os.getenv("OPENAI_API_KEY")
+            if not api_key:
+                raise SystemExit("Missing OPENAI_API_KEY")
+
+            http_client = httpx.Client(
+                http2=find_spec("h2") is not None,
+                timeout=httpx.Timeout(120.0, connect=10.0),
+                limits=httpx.Limits(max_keepalive_connections=4, max_connections=8, keepalive_expiry=60),
+            )
+            # SDK retries off: _call_openai owns the retry policy so attempts don't multiply
+            _client = OpenAI(api_key=api_key, http_client=http_client, max_retries=0)
+        return _client
+
+class RateLimiter:
+    """
+    Token bucket over requests/min and tokens/min (same scheme as OpenAI's
+    api_request_parallel_processor.py): capacity refills with elapsed time and
+    acquire() sleeps until both buckets can cover the next request.
+    """
+
+    def __init__(self, rpm: float, tpm: float):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._requests = rpm
+        self._tokens = tpm
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, estimated_tokens: int) -> None:
+        # A request larger than the whole bucket would wait forever: cap its cost at one full bucket
+        cost = min(float(estimated_tokens), self.tpm)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                elapsed, self._last = now - self._last, now
+                self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60.0)
+                self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60.0)
+                if self._requests >= 1 and self._tokens >= cost:
+                    self._requests -= 1
+                    self._tokens -= cost
+                    return
+                wait = max((1 - self._requests) * 60.0 / self.rpm, (cost - self._tokens) * 60.0 / self.tpm)
+            time.sleep(max(wait, 0.01))
+
+_rate_limiter = RateLimiter(OPENAI_RPM, OPENAI_TPM)
+
+RETRY_ATTEMPTS = 5
+
+_T = TypeVar("_T")
+
+def _retrying(call: Callable[[], _T]) -> _T:
+    # Exponential backoff with jitter (2s, 4s, 8s, ... capped at 60s); honors Retry-After on 429s.
+    # The shared client has SDK retries off, so every API call goes through here.
+    from openai import APIConnectionError, InternalServerError, RateLimitError
+
+    for attempt in range(1, RETRY_ATTEMPTS + 1):
+        try:
+            return call()
+        except (RateLimitError, APIConnectionError, InternalServerError) as e:
+            if attempt == RETRY_ATTEMPTS:
+                raise
+            delay = min(60.0, 2.0 * 2 ** (attempt - 1) + random.uniform(0, 1))
+            response = getattr(e, "response", None)
+            retry_after = response.headers.get("retry-after") if response is not None else None
+            if retry_after:
+                try:
+                    delay = min(60.0, max(delay, float(retry_after)))
+                except ValueError:
+                    pass
+            print(f"OpenAI {type(e).__name__}, retry {attempt}/{RETRY_ATTEMPTS - 1} in {delay:.1f}s")
+            time.sleep(delay)
+
+def _call_openai(client: OpenAI, **kwargs: Any):
+    # ~4 chars per token is close enough for throttling; every attempt (retries too) is charged
+    estimated_tokens = len(dumps(kwargs.get("input", ""))) // 4
+
+    def attempt():
+        _rate_limiter.acquire(estimated_tokens)
+        return client.responses.create(**kwargs)
+
+    return _retrying(attempt)
+
+_BATCH_DONE = ("completed", "failed", "expired", "cancelled")
+
+def _output_text(body: dict) -> str:
+    # Raw Responses API JSON has no output_text convenience field: join the message text parts
+    return "".join(
+        part.get("text", "")
+        for out in body.get("output", [])
+        if out.get("type") == "message"
+        for part in out.get("content", [])
+        if part.get("type") == "output_text"
+    )
 
-    client = OpenAI(api_key=api_key)
-    briefs = build_briefs(N_ITEMS)
-    history = load_history()
-    run_id = sha256(datetime.now().isoformat().encode()).hexdigest()[:8]
+def pending_batch() -> Optional[dict[str, Any]]:
+    """The BATCH_STATE_PATH entry of a batch a previous run submitted but never collected, if any."""
+    try:
+        state = loads(BATCH_STATE_PATH.read_bytes())
+    except (OSError, ValueError):
+        return None
+    return state if isinstance(state, dict) and state.get("batch_id") else None
+
+def _call_batch(client: OpenAI, bodies: dict[str, dict], seed: Optional[int] = None) -> dict[str, str]:
+    """
+    Submits one /v1/responses request per custom_id through the Batch API,
+    polls until the batch finishes and returns {custom_id: output_text}.
+    A batch left pending by an earlier run with the same input is resumed instead of resubmitted.
+    """
+    # Input is kept on disk next to the prompts so a submitted batch can be inspected afterwards
+    payload = b"".join(
+        dumps({"custom_id": cid, "method": "POST", "url": "/v1/responses", "body": body}, newline=True)
+        for cid, body in bodies.items()
+    )
+    digest = hashlib.sha1(payload).hexdigest()
+    atomic_write_bytes(BATCH_INPUT_PATH, payload)
+
+    state = pending_batch()
+    if state is not None and state.get("input_sha1") == digest:
+        batch = _retrying(lambda: client.batches.retrieve(state["batch_id"]))
+        print(f"Resuming batch {batch.id}: {batch.status}")
+    else:
+        def upload():
+            with BATCH_INPUT_PATH.open("rb") as f:  # reopened per attempt: a retry must resend from byte 0
+                return client.files.create(file=f, purpose="batch")
+
+        input_file = _retrying(upload)
+        batch = _retrying(lambda: client.batches.create(
+            input_file_id=input_file.id, endpoint="/v1/responses", completion_window="24h"
+        ))
+        # Recorded before polling: a crashed or cancelled run picks this batch up again instead of paying twice
+        atomic_write_bytes(BATCH_STATE_PATH, dumps(
+            {"batch_id": batch.id, "seed": seed, "input_sha1": digest}, indent=True, newline=True
+        ))
+        print(f"Submitted batch {batch.id} ({len(bodies)} requests)")
+
+    # Poll with backoff: batches take minutes to hours, no need to hit retrieve every 30s throughout
+    delay = BATCH_POLL_SECONDS
+    while batch.status not in _BATCH_DONE:
+        time.sleep(delay)
+        delay = min(delay * 1.5, BATCH_POLL_MAX_SECONDS)
+        batch = _retrying(lambda: client.batches.retrieve(batch.id))
+        print(f"Batch {batch.id}: {batch.status}")
+
+    if batch.status != "completed" or not batch.output_file_id:
+        BATCH_STATE_PATH.unlink(missing_ok=True)  # nothing left to collect; the next run submits anew
+        raise RuntimeError(f"Batch {batch.id} ended with status {batch.status} (errors: {batch.error_file_id})")
+
+    output = _retrying(lambda: client.files.content(batch.output_file_id)).text
+    BATCH_STATE_PATH.unlink(missing_ok=True)
+
+    texts: dict[str, str] = {}
+    for raw in output.splitlines():
+        if not raw.strip():
+            continue
+        row = loads(raw)
+        response = row.get("response") or {}
+        if row.get("error") or response.get("status_code") != 200:
+            raise RuntimeError(f"Batch request {row.get('custom_id')} failed: {row.get('error') or response}")
+        texts[row["custom_id"]] = _output_text(response["body"])
+
+    missing = set(bodies) - set(texts)
+    if missing:
+        raise RuntimeError(f"Batch {batch.id} returned no output for {sorted(missing)}")
+    return texts
 
-    system_prompt = f"""
-You generate premium macro ASMR video and audio prompts.
+# =========================================================
+# GENERATION
+# =========================================================
 
-{BASE_RULES}
+FORBIDDEN_VIDEO_WORDS: tuple[str, ...] = (
+    "hand", "finger",
+    "tool", "spatula", "knife", "bowl", "spoon",
+    "vertical", "wall", "upright", "panel",
+)
+FORBIDDEN_AUDIO_WORDS: tuple[str, ...] = (
+    "water", "liquid", "flow", "pour", "drip", "splash", "stream", "bubble", "honey", "syrup",
+    "knock", "bang", "thump", "click", "scrape", "grind", "metallic", "squeak",
+)
 
-CENTERING / COMPOSITION (MANDATORY):
-- Always keep the main slime mass centered, with wide safe margins from frame edges.
-- Never place slime near edges/corners; no off-center framing; no drift.
-- Include this exact line in every video_prompt (verbatim):
-{COMPOSITION_RULE}
+def _substring_re(words: tuple[str, ...]) -> re.Pattern[str]:
+    # One precompiled alternation, same semantics as `any(w in text.lower() for w in words)`:
+    # unanchored, so compounds (outpouring, overflow, downpour) are rejected as before
+    return re.compile("|".join(map(re.escape, words)), re.IGNORECASE)
 
-{AUDIO_RULES}
+_FORBIDDEN_VIDEO_RE = _substring_re(FORBIDDEN_VIDEO_WORDS)
+_FORBIDDEN_AUDIO_RE = _substring_re(FORBIDDEN_AUDIO_WORDS)
 
-COLOR CONTRAST RULE:
-- If the background is cold or dark (snow, night, blue hour), the slime must use warm or neon colors.
-- If the background is warm (sunset, desert), the slime must include cool or contrasting tones.
-- Never generate plain white, gray, or colorless slime.
+def postprocess_item(item: dict) -> dict:
+    item["surface"] = sanitize_surface(item["surface"])
 
-AUDIO PRIORITY (VERY IMPORTANT):
-- Audio prompts must follow the AUDIO TEMPLATE STYLE.
-- Keep audio prompt short, property-based, and cohesive (not narrative).
-- Allow "slightly moist" but never watery or liquid-like.
+    # Force composition line appended (prevents off-center failures)
+    item["video_prompt"] = ensure_composition_line(item["video_prompt"])
 
-RECENT PROMPTS (AVOID SIMILARITY):
-{json.dumps(history, ensure_ascii=False, indent=2)}
+    # Basic safety: ensure no forbidden terms in video prompt
+    if _FORBIDDEN_VIDEO_RE.search(item["video_prompt"]):
+        raise ValueError("Generated video_prompt contains forbidden content (hands/tools/wall/edge/corner/off-center).")
 
-{AUDIO_STYLE_ANCHOR}
+    # Audio safety: reject if it contains forbidden watery words
+    if _FORBIDDEN_AUDIO_RE.search(item["audio_prompt"]):
+        raise ValueError("Generated audio_prompt contains forbidden watery/mechanical words.")
 
-{JSON_SCHEMA}
-"""
+    return item
+
+def build_request(briefs: List[Brief], history: List[dict[str, Any]]) -> dict:
+    # JSON embedded in the prompt is compact: indentation only adds input tokens
+    # History sits in its own system message after the static prompt, so the cached prefix stays intact;
+    # it is filtered down to the entries these briefs could end up resembling
+    history_prompt = (
+        "RECENT PROMPTS (AVOID SIMILARITY; surface | background | palette):\n"
+        + history_digest(history, briefs)
+    )
 
     user_prompt = f"""
-Generate exactly {N_ITEMS} matched items using the briefs below.
-Use each brief once. Do not repeat environments within this batch.
+Generate exactly {len(briefs)} matched items, one per brief, in brief order.
 Keep prompts concise but vivid.
 
-CRITICAL VIDEO INSTRUCTIONS:
-- The slime must be centered in frame (not near edges/corners) and remain centered.
-- No off-center framing and no lateral drift.
-- Include the composition line.
-
-CRITICAL AUDIO INSTRUCTIONS:
-- Write audio_prompt in the same short style as the template.
-- 2–3 short lines max.
-- Include: thick/cohesive, soft rounded folds, slow calm settling, slightly moist.
-- Include: "Studio-quality close-mic recording, no voice, no music, no ambience. Duration: 8 seconds."
-- Do NOT use: water/watery/liquid/flow/pour/drip/splash/stream/bubbles/honey/syrup or any mechanical sound words.
-
 Briefs:
-{json.dumps([b.__dict__ for b in briefs], ensure_ascii=False, indent=2)}
-
-Return JSON only.
+{dumps([asdict(b) for b in briefs]).decode()}
 """
 
-    resp = client.responses.create(
-        model=MODEL,
-        input=[
-            {"role": "system", "content": system_prompt},
+    return {
+        "model": MODEL,
+        "input": [
+            {"role": "system", "content": STATIC_SYSTEM_PROMPT},
+            {"role": "system", "content": history_prompt},
             {"role": "user", "content": user_prompt},
         ],
-        temperature=TEMPERATURE,
-    )
+        "temperature": TEMPERATURE,
+        "text": {"format": RESPONSE_FORMAT},
+    }
+
+def parse_items(text: str, briefs: List[Brief]) -> List[dict]:
+    data = loads(text)["items"]
+
+    validate_output(data)
+    if len(data) != len(briefs):
+        raise ValueError(f"Model did not return a JSON list with exactly {len(briefs)} items.")
+
+    return [
+        postprocess_item({
+            "id": item["id"],
+            "surface": brief.surface,
+            "background": brief.background,
+            "palette": brief.palette,
+            "slime_type": brief.slime["type"],
+            "video_prompt": item["video_prompt"],
+            "audio_prompt": item["audio_prompt"],
+        })
+        for brief, item in zip(briefs, data)
+    ]
+
+def log_usage(responses) -> None:
+    # cached_tokens > 0 confirms the static prefix is hitting OpenAI's prompt cache
+    usages = [r.usage for r in responses if getattr(r, "usage", None) is not None]
+    if not usages:
+        return
+    total = sum(u.input_tokens for u in usages)
+    cached = sum(getattr(u.input_tokens_details, "cached_tokens", 0) or 0 for u in usages)
+    print(f"OpenAI input tokens {total} (cached {cached})")
+
+def generate_items(
+    client: OpenAI,
+    briefs: List[Brief],
+    history: List[dict[str, Any]],
+    use_batch: bool = USE_BATCH_API,
+    seed: Optional[int] = None,
+) -> List[dict]:
+    # Briefs are packed ITEMS_PER_REQUEST per request (one shared system prompt per chunk); chunks are
+    # sent concurrently (the OpenAI client is thread-safe) and results keep brief order
+    size = max(1, ITEMS_PER_REQUEST)
+    groups = [briefs[i:i + size] for i in range(0, len(briefs), size)]
+    bodies = {f"chunk-{i}": build_request(g, history) for i, g in enumerate(groups)}
+
+    if use_batch:
+        texts = _call_batch(client, bodies, seed)
+    else:
+        with ThreadPoolExecutor(max_workers=min(len(bodies), MAX_CONCURRENT)) as ex:
+            futures = {cid: ex.submit(_call_openai, client, **body) for cid, body in bodies.items()}
+            responses = {cid: f.result() for cid, f in futures.items()}
+        texts = {cid: r.output_text for cid, r in responses.items()}
+        log_usage(responses.values())
+
+    return [item for cid, group in zip(bodies, groups) for item in parse_items(texts[cid], group)]
+
+def brief_key(brief: Brief) -> str:
+    # The whole static system prompt (every rule block, not just BASE_RULES) and the output schema are
+    # part of the key, so any prompt edit invalidates old entries. The history digest is left out on
+    # purpose: it changes every run and would turn every lookup into a miss.
+    return _prompt_cache.make_key(MODEL, TEMPERATURE, asdict(brief), STATIC_SYSTEM_PROMPT, RESPONSE_FORMAT)
+
+# =========================================================
+# MAIN
+# =========================================================
 
-    text = resp.output_text.strip()
-    data = json.loads(text)
-
-    if not isinstance(data, list) or len(data) != N_ITEMS:
-        raise ValueError(f"Model did not return a JSON list with exactly {N_ITEMS} items.")
-
-    for i, item in enumerate(data, start=1):
-        item["id"] = i
-        item["surface"] = sanitize_surface(item.get("surface", "horizontal tabletop"))
-
-        # Force composition line appended (prevents off-center failures)
-        item["video_prompt"] = ensure_composition_line(str(item.get("video_prompt", "")))
-
-        # Basic safety: ensure no forbidden terms in video prompt
-        vp = str(item.get("video_prompt", "")).lower()
-        forbidden_video = [
-    "hand", "hands", "finger", "fingers",
-    "tool", "tools", "spatula", "knife", "bowl", "spoon",
-    "vertical", "wall", "upright", "panel"
-]
-        if any(x in vp for x in forbidden_video):
-            raise ValueError("Generated video_prompt contains forbidden content (hands/tools/wall/edge/corner/off-center).")
-
-        # Audio safety: reject if it contains forbidden watery words
-        ap = str(item.get("audio_prompt", "")).lower()
-        forbidden_audio = [
-            "water", "watery", "liquid", "flow", "pour", "drip", "splash", "stream", "bubbles", "honey", "syrup",
-            "knock", "bang", "thump", "click", "scrape", "grind", "metallic", "squeak"
-        ]
-        if any(w in ap for w in forbidden_audio):
-            raise ValueError("Generated audio_prompt contains forbidden watery/mechanical words.")
-
-    OUT_PATH.parent.mkdir(parents=True, exist_ok=True)
-    OUT_PATH.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
-
-    save_history([
-        {
-            "run": run_id,
-            "surface": d.get("surface"),
-            "background": d.get("background"),
-            "palette": d.get("palette"),
-            "slime_type": d.get("slime_type"),
-        }
-        for d in data
-    ])
-
-    print(f"Wrote {OUT_PATH} | run {run_id}")
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--days", type=int, default=1,
+                    help="Generate prompts for N consecutive days in one run (default 1)")
+    ap.add_argument("--batch", action="store_true", default=USE_BATCH_API,
+                    help="Use the OpenAI Batch API (cheaper, async up to 24h; also USE_BATCH_API=1)")
+    args = ap.parse_args()
+    if args.days < 1:
+        raise SystemExit("--days must be >= 1")
+    migrate_legacy_history()
+
+    # One brief set per day, so the no-duplicates guarantee holds within each day
+    # Always seeded, and the seed is logged + stored in history, so any run can be replayed with SLIME_SEED
+    # A pending batch's own seed comes first: same briefs -> same batch input -> resume, not resubmit
+    pending = pending_batch() if args.batch and not SEED else None
+    if pending is not None and pending.get("seed") is not None:
+        seed = int(pending["seed"])
+        print(f"Pending batch {pending['batch_id']}: reusing its seed {seed}")
+    else:
+        seed = int(SEED) if SEED else int.from_bytes(os.urandom(8), "little")
+    rng = random.Random(seed)
+    briefs = [b for _ in range(args.days) for b in build_briefs(N_ITEMS, rng)]
+    run_id = token_hex(4)
+
+    # Only briefs without a cached item go to the model
+    keys = [brief_key(b) for b in briefs]
+    data = [_prompt_cache.get(k) for k in keys]
+    misses = [i for i, d in enumerate(data) if d is None]
+
+    if misses:
+        generated = generate_items(get_client(), [briefs[i] for i in misses], load_history(), args.batch, seed)
+        for i, item in zip(misses, generated):
+            _prompt_cache.put(keys[i], item)
+            data[i] = item
+
+    # Demux: items come back in brief order, N_ITEMS per day. One pass renumbers ids per day and
+    # builds the history batch alongside.
+    ts = time.time_ns()  # integer epoch ns; format only when reading history back, if ever
+    days = [data[d * N_ITEMS:(d + 1) * N_ITEMS] for d in range(args.days)]
+    history_batch = []
+    for items in days:
+        for i, item in enumerate(items, start=1):
+            item["id"] = i
+            history_batch.append({
+                "run": run_id,
+                "ts": ts,
+                "seed": seed,
+                "surface": item["surface"],
+                "background": item["background"],
+                "palette": item["palette"],
+                "slime_type": item["slime_type"],
+            })
+
+    atomic_write_bytes(OUT_PATH, dumps(days[0], indent=True, newline=True))
+    if args.days > 1:
+        today = date.today()
+        for d, items in enumerate(days):
+            day_path = OUT_PATH.parent / f"{(today + timedelta(days=d)).isoformat()}.json"
+            atomic_write_bytes(day_path, dumps(items, indent=True, newline=True))
+            print(f"Wrote {day_path}")
+
+    save_history(history_batch)
+
+    print(f"Wrote {OUT_PATH} | run {run_id} | seed {seed} | cache hits {len(briefs) - len(misses)}/{len(briefs)}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -2,14 +2,50 @@
 from __future__ import annotations
 
 import argparse
-import subprocess
 from pathlib import Path
 
+from _ffmpeg import FFMPEG_BASE, loop_xfade_graph, run, stream_loop_count
 
-def run(cmd: list[str]) -> None:
-    p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
-    if p.returncode != 0:
-        raise RuntimeError(f"Command failed:\n{' '.join(cmd)}\n\nOutput:\n{p.stdout}")
+try:
+    import numpy as np
+    import soundfile as sf
+except ImportError:  # optional: without them every loop goes through ffmpeg
+    np = None
+    sf = None
+
+OUT_RATE = 48000
+
+
+def _loop_in_process(in_audio: Path, out_audio: Path, T: float, F: float) -> bool:
+    """
+    Same loop + linear (tri) end->start crossfade as the ffmpeg graph, done on the PCM buffer.
+    Returns False when it can't match ffmpeg's output exactly (libs missing, non-.wav output, format
+    libsndfile can't read, sample rate other than 48 kHz, > 2 channels) so the caller falls back to ffmpeg.
+    """
+    if np is None or sf is None:
+        return False
+    if out_audio.suffix.lower() != ".wav":
+        return False  # sf.write picks the container from the extension; mp3/m4a etc. stay with ffmpeg
+    try:
+        data, rate = sf.read(str(in_audio), dtype="float32", always_2d=True)
+    except RuntimeError:  # LibsndfileError subclasses it: unreadable or unsupported format
+        return False
+    if rate != OUT_RATE or len(data) == 0 or data.shape[1] > 2:
+        return False  # resampling/downmixing stays with ffmpeg's swresample
+
+    n_target = int(round(T * OUT_RATE))
+    n_fade = int(round(F * OUT_RATE))
+    reps = -(-n_target // len(data))  # ceil
+    buf = np.tile(data, (reps, 1))[:n_target]
+
+    w = np.linspace(0.0, 1.0, n_fade, dtype=np.float32)[:, None]
+    xf = buf[n_target - n_fade:] * (1.0 - w) + buf[:n_fade] * w
+    out = np.concatenate([buf[:n_target - n_fade], xf])
+    if out.shape[1] == 1:
+        out = np.repeat(out, 2, axis=1)  # -ac 2 equivalent for mono input
+
+    sf.write(str(out_audio), np.clip(out, -1.0, 1.0), OUT_RATE, subtype="PCM_16")
+    return True
 
 
 def loop_audio_to_duration(
@@ -56,19 +92,16 @@ def loop_audio_to_duration(
     if F <= 0 or F >= T:
         raise ValueError("crossfade_seconds must be > 0 and < target_seconds")
 
+    # A few MB of PCM: NumPy does this in milliseconds, without an ffmpeg process
+    if _loop_in_process(in_audio, out_audio, T, F):
+        return
+
     # Use -stream_loop to ensure enough length
     cmd = [
-        "ffmpeg", "-y",
-        "-stream_loop", "10",  # repeat input enough times
+        *FFMPEG_BASE, "-y",
+        "-stream_loop", str(stream_loop_count(in_audio, T)),  # repeat input just enough times
         "-i", str(in_audio),
-        "-filter_complex",
-        (
-            f"[0:a]atrim=0:{T-F},asetpts=PTS-STARTPTS[mid];"
-            f"[0:a]atrim={T-F}:{T},asetpts=PTS-STARTPTS[tail];"
-            f"[0:a]atrim=0:{F},asetpts=PTS-STARTPTS[head];"
-            f"[tail][head]acrossfade=d={F}:c1=tri:c2=tri[xf];"
-            f"[mid][xf]concat=n=2:v=0:a=1[outa]"
-        ),
+        "-filter_complex", loop_xfade_graph("0:a", T, F),
         "-map", "[outa]",
         "-t", f"{T}",
         "-ac", "2",
@@ -1,4 +1,7 @@
-import os, json, subprocess, sys
+import os, subprocess, sys
+
+from _ffmpeg import DEFAULT_THREADS, FFMPEG_BASE, detect_hw_encoder, encoder_args, thread_args
+from _jsonio import loads
 
 PROMPTS_PATH = "prompts/prompts_today.json"
 VIDEO_DIR = "video_raw"
@@ -6,9 +9,11 @@ AUDIO_DIR = "audio_raw"
 FINAL_DIR = "final"
 
 def list_mp4s():
-    files = [f for f in os.listdir(VIDEO_DIR) if f.lower().endswith(".mp4")]
-    files.sort(key=lambda f: os.path.getmtime(os.path.join(VIDEO_DIR, f)))
-    return files
+    # One scandir pass: type and mtime come from the DirEntry, no join + getmtime per file
+    with os.scandir(VIDEO_DIR) as it:
+        rows = [(e.stat().st_mtime, e.name) for e in it if e.is_file() and e.name.lower().endswith(".mp4")]
+    rows.sort()
+    return [name for _, name in rows]
 
 def run(cmd):
     print(" ".join(cmd))
@@ -17,8 +22,8 @@ def run(cmd):
 def main():
     os.makedirs(FINAL_DIR, exist_ok=True)
 
-    with open(PROMPTS_PATH, "r", encoding="utf-8") as f:
-        data = json.load(f)
+    with open(PROMPTS_PATH, "rb") as f:
+        data = loads(f.read())
     shorts = data
     if len(shorts) < 1:
         print("No shorts in prompts file.")
@@ -39,14 +44,17 @@ def main():
             print("Missing audio:", audio_path)
             sys.exit(1)
 
+        pre, enc = encoder_args(detect_hw_encoder())
         run([
-            "ffmpeg", "-y",
+            *FFMPEG_BASE, "-y",
+            *pre,
             "-stream_loop", "1", "-i", video_path,
             "-stream_loop", "1", "-i", audio_path,
             "-t", "10",
-            "-c:v", "libx264",
-            "-pix_fmt", "yuv420p",
+            *enc,
+            *thread_args(DEFAULT_THREADS),
             "-c:a", "aac",
+            "-movflags", "+faststart",
             out_path
         ])
 
@@ -2,12 +2,29 @@
 from __future__ import annotations
 
 import argparse
-import json
+import errno
+import os
 import shutil
-import subprocess
-from datetime import datetime
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date
+from itertools import count
 from pathlib import Path
 
+from _ffmpeg import (
+    DEFAULT_THREADS,
+    FFMPEG_BASE,
+    audio_loop_args,
+    can_copy_video,
+    detect_hw_encoder,
+    encoder_args,
+    ffprobe,
+    probe_video,
+    run,
+    thread_args,
+)
+from _jsonio import loads
+
 
 VIDEO_INBOX = Path("video_raw")
 VIDEO_DONE = Path("video_done")
@@ -19,89 +36,206 @@ PROMPTS_PATH = Path("prompts/prompts_today.json")
 LOOPED_AUDIO_DIR = Path("audio_looped")
 
 
-def run(cmd: list[str]) -> None:
-    p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
-    if p.returncode != 0:
-        raise RuntimeError(f"Command failed:\n{' '.join(cmd)}\n\nOutput:\n{p.stdout}")
+VIDEO_EXTS = frozenset({".mp4", ".mov", ".m4v"})
+AUDIO_EXTS = frozenset({".wav", ".mp3", ".m4a"})
 
 
-def list_files(folder: Path, exts: tuple[str, ...]) -> list[Path]:
+def list_files(folder: Path, exts: frozenset[str]) -> list[Path]:
     folder.mkdir(parents=True, exist_ok=True)
-    files = [p for p in folder.iterdir() if p.is_file() and p.suffix.lower() in exts]
-    files.sort(key=lambda p: p.stat().st_mtime)  # oldest first
-    return files
+    # One scandir pass: DirEntry carries the type and caches stat(), so no per-file is_file()/stat() calls
+    with os.scandir(folder) as it:
+        entries = [
+            (e.stat().st_mtime, e.name)
+            for e in it
+            if e.is_file() and os.path.splitext(e.name)[1].lower() in exts
+        ]
+    entries.sort()  # oldest first; name breaks mtime ties deterministically
+    return [folder / name for _, name in entries]
 
 
 def safe_move(src: Path, dst_dir: Path) -> Path:
     dst_dir.mkdir(parents=True, exist_ok=True)
-    dst = dst_dir / src.name
-    if dst.exists():
-        i = 1
-        while True:
-            cand = dst_dir / f"{src.stem}_{i}{src.suffix}"
-            if not cand.exists():
-                dst = cand
-                break
-            i += 1
-    shutil.move(str(src), str(dst))
-    return dst
-
-
-def loop_audio_to_10s(in_audio: Path, out_audio: Path, seconds: float = 10.0, xfade: float = 0.35) -> None:
+    for i in count():
+        dst = dst_dir / (src.name if i == 0 else f"{src.stem}_{i}{src.suffix}")
+        # O_EXCL reserves the name atomically, so concurrent workers can never pick the same one
+        try:
+            os.close(os.open(dst, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644))
+        except FileExistsError:
+            continue
+        try:
+            os.replace(src, dst)  # same filesystem: a rename over the placeholder, no data copied
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                dst.unlink(missing_ok=True)
+                raise
+            shutil.move(str(src), str(dst))  # across devices only: copy + delete
+        return dst
+
+
+def _part(path: Path) -> Path:
+    # Same extension, so ffmpeg still picks the muxer from the file name
+    return path.with_name(f"{path.stem}.part{path.suffix}")
+
+
+def source_tag(video: Path, audio: Path) -> str:
+    return f"src:{video.name}|{audio.name}"
+
+
+def already_merged(out: Path, tag: str, looped: Path | None) -> bool:
+    # Outputs only appear after a successful run (see _part), so an existing file with our source tag
+    # is complete. The tag matters: after a partial run the inbox shifts and index NN maps to new inputs.
+    if not out.exists() or (looped is not None and not looped.exists()):
+        return False
+    tags = (ffprobe(out).get("format") or {}).get("tags") or {}
+    return tags.get("comment") == tag
+
+
+def merge_video_and_looped_audio(
+    video: Path,
+    raw_audio: Path,
+    out_mp4: Path,
+    seconds: float = 10.0,
+    xfade: float = 0.35,
+    keep_audio: Path | None = None,
+    comment: str | None = None,
+    threads: int = DEFAULT_THREADS,
+) -> None:
     """
-    Wraps ffmpeg looping into a 10s WAV (good for ASMR).
+    One ffmpeg pass: loops the raw audio to `seconds` with an end->start crossfade
+    (good for ASMR; skipped when generate_audio --loop already looped the audio)
+    and muxes it with the video. No intermediate WAV unless keep_audio is given.
+    Outputs are written to .part files and renamed into place only after ffmpeg succeeds.
     """
-    out_audio.parent.mkdir(parents=True, exist_ok=True)
+    out_mp4.parent.mkdir(parents=True, exist_ok=True)
 
     T = float(seconds)
     F = float(xfade)
     if F <= 0 or F >= T:
         raise ValueError("xfade must be > 0 and < seconds")
 
-    cmd = [
-        "ffmpeg", "-y",
-        "-stream_loop", "10",
-        "-i", str(in_audio),
-        "-filter_complex",
-        (
-            f"[0:a]atrim=0:{T-F},asetpts=PTS-STARTPTS[mid];"
-            f"[0:a]atrim={T-F}:{T},asetpts=PTS-STARTPTS[tail];"
-            f"[0:a]atrim=0:{F},asetpts=PTS-STARTPTS[head];"
-            f"[tail][head]acrossfade=d={F}:c1=tri:c2=tri[xf];"
-            f"[mid][xf]concat=n=2:v=0:a=1[outa]"
-        ),
-        "-map", "[outa]",
-        "-t", f"{T}",
-        "-ac", "2",
-        "-ar", "48000",
-        str(out_audio),
-    ]
-    run(cmd)
-
+    if can_copy_video(video, T):
+        # Source is already H.264 yuv420p and long enough: mux only (keeps the source frame rate)
+        pre, enc = [], ["-c:v", "copy", *thread_args(threads, copy=True)]
+    else:
+        pre, enc = encoder_args(detect_hw_encoder())  # hardware H.264 when available, libx264 otherwise
+        enc = [*enc, "-r", "30", *thread_args(threads)]
+
+    audio_in, graph = audio_loop_args("1:a", raw_audio, T, F)  # pre-looped audio skips the loop graph
+    mux_label = "[outa]"
+    keep_out: list[str] = []
+    if keep_audio is not None:
+        # Second output of the same graph, so keeping the WAV costs no extra decode
+        keep_audio.parent.mkdir(parents=True, exist_ok=True)
+        graph += ";[outa]asplit=2[muxa][keepa]"
+        mux_label = "[muxa]"
+        keep_out = ["-map", "[keepa]", "-t", f"{T}", "-ac", "2", "-ar", "48000", str(_part(keep_audio))]
 
-def merge_video_audio(video: Path, audio: Path, out_mp4: Path) -> None:
-    out_mp4.parent.mkdir(parents=True, exist_ok=True)
     cmd = [
-        "ffmpeg", "-y",
+        *FFMPEG_BASE, "-y",
+        *pre,
+        "-fflags", "+genpts",  # input option: regenerate missing PTS, which stream copy relies on
         "-i", str(video),
-        "-i", str(audio),
-        "-t", "10",
-        "-c:v", "libx264",
-        "-pix_fmt", "yuv420p",
-        "-r", "30",
+        *audio_in,
+        "-i", str(raw_audio),
+        "-filter_complex", graph,
+        "-map", "0:v",
+        "-map", mux_label,
+        "-t", f"{T}",
+        *enc,
         "-c:a", "aac",
         "-b:a", "192k",
+        "-ac", "2",
+        "-ar", "48000",
         "-shortest",
-        str(out_mp4),
+        "-movflags", "+faststart",  # moov atom up front: playable/seekable before fully read
+        *(["-metadata", f"comment={comment}"] if comment else []),
+        str(_part(out_mp4)),
+        *keep_out,
     ]
-    run(cmd)
+    parts = [(_part(out_mp4), out_mp4)] + ([(_part(keep_audio), keep_audio)] if keep_audio is not None else [])
+    try:
+        run(cmd)
+    except BaseException:
+        for part, _ in parts:
+            part.unlink(missing_ok=True)
+        raise
+    for part, final in parts:
+        os.replace(part, final)
+
+
+def _concat_list_line(path: Path) -> str:
+    # concat demuxer syntax: single-quoted, a literal ' is written as '\''
+    return "file '" + str(path.resolve()).replace("'", "'\\''") + "'\n"
+
+
+def concat_reel(clips: list[Path], reel_mp4: Path, threads: int = DEFAULT_THREADS) -> None:
+    """
+    Joins finished clips into reel_mp4. When all clips share codec/size/pix_fmt/frame rate (the
+    usual case: every clip went through the same encode) the concat demuxer stream-copies them;
+    otherwise one extra encode of just the reel, letterboxed to the first clip's frame size.
+    """
+    if not clips:
+        return
+    reel_mp4.parent.mkdir(parents=True, exist_ok=True)
+    infos = [probe_video(c) for c in clips]
+    fields = ("codec_name", "width", "height", "pix_fmt", "r_frame_rate")
+    shapes = {tuple(info.get(k) for k in fields) for info in infos}
+    part = _part(reel_mp4)
+
+    list_file = None
+    if len(shapes) == 1 and None not in next(iter(shapes)):
+        with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False, encoding="utf-8") as f:
+            f.writelines(_concat_list_line(c) for c in clips)
+        list_file = Path(f.name)
+        cmd = [
+            *FFMPEG_BASE, "-y",
+            "-f", "concat", "-safe", "0", "-i", str(list_file),
+            "-c", "copy", *thread_args(threads, copy=True),
+            "-movflags", "+faststart",
+            str(part),
+        ]
+    else:
+        encoder = detect_hw_encoder()
+        if encoder == "h264_vaapi":
+            # VAAPI needs -vf hwupload, which ffmpeg refuses on streams from -filter_complex
+            encoder = "libx264"
+        pre, enc = encoder_args(encoder)
+        w, h = infos[0].get("width"), infos[0].get("height")
+        fit = f"scale={w}:{h}:force_original_aspect_ratio=decrease,pad={w}:{h}:(ow-iw)/2:(oh-ih)/2," if w and h else ""
+        inputs: list[str] = []
+        graph: list[str] = []
+        for i, clip in enumerate(clips):
+            inputs += ["-i", str(clip)]
+            graph.append(f"[{i}:v]{fit}setsar=1,fps=30,format=yuv420p[v{i}]")
+            graph.append(f"[{i}:a]aformat=sample_rates=48000:channel_layouts=stereo[a{i}]")
+        segments = "".join(f"[v{i}][a{i}]" for i in range(len(clips)))
+        graph.append(f"{segments}concat=n={len(clips)}:v=1:a=1[reelv][reela]")
+        cmd = [
+            *FFMPEG_BASE, "-y", *pre, *inputs,
+            "-filter_complex", ";".join(graph),
+            "-map", "[reelv]", "-map", "[reela]",
+            *enc, *thread_args(threads),
+            "-c:a", "aac", "-b:a", "192k",
+            "-movflags", "+faststart",
+            str(part),
+        ]
+
+    try:
+        run(cmd)
+    except BaseException:
+        part.unlink(missing_ok=True)
+        raise
+    finally:
+        if list_file is not None:
+            list_file.unlink(missing_ok=True)
+    os.replace(part, reel_mp4)
 
 
 def load_prompts(path: Path) -> list[dict]:
     if not path.exists():
         return []
     try:
-        data = json.loads(path.read_text(encoding="utf-8"))
+        data = loads(path.read_bytes())  # orjson parses the bytes directly when installed
         if isinstance(data, list):
             return data
         if isinstance(data, dict) and "items" in data and isinstance(data["items"], list):
@@ -111,20 +245,63 @@ def load_prompts(path: Path) -> list[dict]:
     return []
 
 
+def process_item(
+    v: Path,
+    a: Path,
+    out: Path,
+    looped: Path | None,
+    seconds: float,
+    xfade: float,
+    force: bool = False,
+    threads: int = DEFAULT_THREADS,
+) -> Path:
+    tag = source_tag(v, a)
+    if not force and already_merged(out, tag, looped):
+        # Finished by an earlier run that stopped before archiving: only the moves are left
+        print(f"SKIP (already merged): {out}")
+    else:
+        # 1) loop audio + merge in one ffmpeg pass
+        merge_video_and_looped_audio(
+            v, a, out, seconds=seconds, xfade=xfade, keep_audio=looped, comment=tag, threads=threads
+        )
+
+    # 2) archive originals (so they NEVER get reused)
+    safe_move(v, VIDEO_DONE)
+    safe_move(a, AUDIO_DONE)
+    return out
+
+
+def default_parallel() -> int:
+    # Consumer GPUs cap concurrent encode sessions; x264 runs are spread over the cores
+    if detect_hw_encoder() != "libx264":
+        return 2
+    return max(1, (os.cpu_count() or 2) // 2)
+
+
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--count", type=int, default=3, help="How many videos to process from inbox (default 3)")
     ap.add_argument("--seconds", type=float, default=10.0, help="Target duration (default 10)")
     ap.add_argument("--xfade", type=float, default=0.35, help="Audio crossfade seconds (default 0.35)")
+    ap.add_argument("--keep-audio", action="store_true",
+                    help=f"Also write the looped WAV to {LOOPED_AUDIO_DIR}/ (off by default)")
+    ap.add_argument("--force", action="store_true",
+                    help="Re-merge even if the output already exists for the same inputs")
+    ap.add_argument("--reel", action="store_true",
+                    help="Also join the merged clips into one reel (stream copy when the clips match)")
+    ap.add_argument("--ffmpeg-threads", type=int, default=DEFAULT_THREADS,
+                    help=f"Threads per ffmpeg process, 0 = ffmpeg's auto "
+                         f"(default {DEFAULT_THREADS}; also FFMPEG_THREADS)")
+    ap.add_argument("--parallel", type=int, default=None,
+                    help="Items merged concurrently (default: 2 with a HW encoder, else half the CPU cores)")
     args = ap.parse_args()
 
     FINAL_DIR.mkdir(exist_ok=True)
-    LOOPED_AUDIO_DIR.mkdir(exist_ok=True)
 
     prompts = load_prompts(PROMPTS_PATH)  # optional; only used for logging
 
-    videos = list_files(VIDEO_INBOX, (".mp4", ".mov", ".m4v"))
-    audios = list_files(AUDIO_INBOX, (".wav", ".mp3", ".m4a"))
+    videos = list_files(VIDEO_INBOX, VIDEO_EXTS)
+    audios = list_files(AUDIO_INBOX, AUDIO_EXTS)
 
     if not videos:
         raise SystemExit("No new videos found in video_raw/")
@@ -135,8 +312,9 @@ def main():
     if n <= 0:
         raise SystemExit("Nothing to process.")
 
-    stamp = datetime.now().strftime("%Y%m%d")
+    stamp = date.today().strftime("%Y%m%d")
 
+    jobs = []
     for i in range(n):
         v = videos[i]
         a = audios[i]
@@ -151,20 +329,27 @@ def main():
             if theme:
                 tag = f"_{theme}"
 
-        looped = LOOPED_AUDIO_DIR / f"audio_{stamp}_{idx:02d}_10s.wav"
+        looped = LOOPED_AUDIO_DIR / f"audio_{stamp}_{idx:02d}_10s.wav" if args.keep_audio else None
         out = FINAL_DIR / f"slime_{stamp}_{idx:02d}{tag}.mp4"
-
-        # 1) make 10s audio
-        loop_audio_to_10s(a, looped, seconds=args.seconds, xfade=args.xfade)
-
-        # 2) merge
-        merge_video_audio(v, looped, out)
-
-        # 3) archive originals (so they NEVER get reused)
-        safe_move(v, VIDEO_DONE)
-        safe_move(a, AUDIO_DONE)
-
-        print(f"OK: {out}")
+        jobs.append((v, a, out, looped))
+
+    # Each item is an independent ffmpeg subprocess, so threads are enough to run them side by side
+    workers = max(1, min(args.parallel or default_parallel(), n))
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        futures = [
+            ex.submit(process_item, *job, args.seconds, args.xfade, args.force, args.ffmpeg_threads)
+            for job in jobs
+        ]
+        for f in as_completed(futures):
+            print(f"OK: {f.result()}")
+
+    if args.reel:
+        # After the pool, from the finished files: skip/--force/stream copy all apply per item as usual
+        reel = FINAL_DIR / f"slime_{stamp}_reel.mp4"
+        concat_reel([out for _, _, out, _ in jobs], reel, threads=args.ffmpeg_threads)
+        print(f"OK: {reel}")
+        print(f"Done. Created {n} final videos + reel in {FINAL_DIR}/")
+        return
 
     print(f"Done. Created {n} final videos in {FINAL_DIR}/")
 